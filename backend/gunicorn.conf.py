@@ -0,0 +1,23 @@
+"""
+Gunicorn configuration for production
+Runs the FastAPI app on Uvicorn workers, one event loop per process
+"""
+
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+worker_class = "uvicorn.workers.UvicornWorker"
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+timeout = 60
+graceful_timeout = 30
+keepalive = 5
+
+
+def on_starting(server):
+    """Create and migrate the schema once in the master, before any worker boots"""
+    from main import init_db
+
+    init_db()
+    # Inherited by the forked workers so their lifespan skips schema setup
+    os.environ["MEDLINK_DB_INITIALIZED"] = "1"
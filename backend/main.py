@@ -3,19 +3,35 @@ MedLink SMS - FastAPI Backend
 Healthcare communication platform for sending lab results via Africa's Talking SMS API
 """
 
-from stellar_service import log_transaction_safe
-from fastapi import FastAPI, HTTPException, Depends, status
+from stellar_service import enqueue_transaction_log
+from fastapi import FastAPI, HTTPException, Depends, Query, status
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from pydantic import BaseModel, EmailStr, Field
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, ForeignKey
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, ORJSONResponse
+from pydantic import BaseModel, EmailStr, Field, field_validator
+from sqlalchemy import create_engine, event, inspect, make_url, Column, Integer, SmallInteger, String, DateTime, ForeignKey, Index, tuple_, select, insert, update, func, case
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, Session, relationship
+from sqlalchemy.orm import relationship
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool
 from passlib.context import CryptContext
 from jose import JWTError, jwt
-from datetime import datetime, timedelta
-from typing import Optional, List
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from enum import IntEnum
+from hashlib import blake2b
+from secrets import token_hex
+from typing import Optional, List, NamedTuple, Union
+from cachetools import TTLCache
+from aiolimiter import AsyncLimiter
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
+import asyncio
 import os
+import time
+import httpx
+import orjson
+import redis.asyncio as redis
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -28,19 +44,119 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 1440  # 24 hours
 
 AFRICASTALKING_USERNAME = os.getenv("AFRICASTALKING_USERNAME", "sandbox")
 AFRICASTALKING_API_KEY = os.getenv("AFRICASTALKING_API_KEY", "mock-api-key")
+AFRICASTALKING_SMS_URL = (
+    "https://api.sandbox.africastalking.com/version1/messaging"
+    if AFRICASTALKING_USERNAME == "sandbox"
+    else "https://api.africastalking.com/version1/messaging"
+)
+SMS_MAX_CONCURRENCY = int(os.getenv("SMS_MAX_CONCURRENCY", "10"))  # in-flight API calls
+SMS_RATE_PER_SECOND = int(os.getenv("SMS_RATE_PER_SECOND", "30"))  # token bucket refill rate
+
+MAX_CONCURRENT_REQUESTS = int(os.getenv("MAX_CONCURRENT_REQUESTS", "500"))  # per worker
+
+REDIS_URL = os.getenv("REDIS_URL")  # optional, shares the analytics cache across workers
+ANALYTICS_CACHE_TTL_SECONDS = 15
 
 # Database setup
-DATABASE_URL = "sqlite:///./medlink.db"
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+DATABASE_URL = "sqlite+aiosqlite:///./medlink.db"
+engine = create_async_engine(
+    DATABASE_URL,
+    connect_args={"check_same_thread": False},
+    poolclass=AsyncAdaptedQueuePool,  # aiosqlite defaults to NullPool (new connection per checkout)
+    pool_size=10,
+    max_overflow=20,
+    query_cache_size=1200
+)
+
+@event.listens_for(engine.sync_engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """WAL lets readers proceed while a writer is active; busy_timeout waits instead of failing on locks"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    # Read-heavy workload: memory-map up to 256MB of the file, 64MB page cache per connection
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.execute("PRAGMA cache_size=-65536")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+SessionLocal = async_sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False, autoflush=False)
 Base = declarative_base()
 
+# Authenticated user cache (email -> CurrentUser), skips the user lookup per request
+USER_CACHE_TTL_SECONDS = 60
+user_cache: TTLCache = TTLCache(maxsize=10_000, ttl=USER_CACHE_TTL_SECONDS)
+
+# Verified JWT payloads (blake2b digest of token -> payload), skips HMAC checks for repeat tokens
+# Entries are also checked against the token's own exp on every hit
+TOKEN_CACHE_TTL_SECONDS = 300
+token_cache: TTLCache = TTLCache(maxsize=10_000, ttl=TOKEN_CACHE_TTL_SECONDS)
+
+# Analytics response cache (user_id -> analytics dict)
+# Redis when REDIS_URL is set, otherwise a per-process TTLCache
+redis_client = redis.from_url(REDIS_URL) if REDIS_URL else None
+analytics_cache: TTLCache = TTLCache(maxsize=10_000, ttl=ANALYTICS_CACHE_TTL_SECONDS)
+
 # Password hashing
-pwd_context = CryptContext(schemes=["sha256_crypt"], deprecated="auto")
+# sha256_crypt stays listed so existing hashes still verify; they are upgraded on login
+pwd_context = CryptContext(schemes=["bcrypt", "sha256_crypt"], deprecated="auto", bcrypt__rounds=12)
 security = HTTPBearer()
 
+# Shared HTTP client for Africa's Talking (reuses connections across requests)
+http_client = httpx.AsyncClient(timeout=10.0)
+sms_semaphore = asyncio.Semaphore(SMS_MAX_CONCURRENCY)
+sms_rate_limiter = AsyncLimiter(max_rate=SMS_RATE_PER_SECOND, time_period=1)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Set up the schema when running standalone and release pooled connections on shutdown"""
+    # Under gunicorn the master already ran init_db before forking workers
+    if not os.getenv("MEDLINK_DB_INITIALIZED"):
+        await run_in_threadpool(init_db)
+    yield
+    await http_client.aclose()
+    if redis_client is not None:
+        await redis_client.aclose()
+    await engine.dispose()
+
 # Initialize FastAPI
-app = FastAPI(title="MedLink SMS API", version="1.0.0")
+app = FastAPI(
+    title="MedLink SMS API",
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
+)
+
+class ConcurrencyLimitMiddleware:
+    """Shed load with 503 once too many requests are in flight in this worker"""
+    
+    def __init__(self, app, max_concurrent: int):
+        self.app = app
+        self.max_concurrent = max_concurrent
+        self.in_flight = 0
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        if self.in_flight >= self.max_concurrent:
+            response = JSONResponse(
+                {"detail": "Server busy, please retry"},
+                status_code=503,
+                headers={"Retry-After": "1"}
+            )
+            await response(scope, receive, send)
+            return
+        
+        self.in_flight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.in_flight -= 1
+
+app.add_middleware(ConcurrencyLimitMiddleware, max_concurrent=MAX_CONCURRENT_REQUESTS)
 
 # CORS Configuration
 app.add_middleware(
@@ -49,10 +165,23 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 # ============== DATABASE MODELS ==============
 
+def utc_now() -> datetime:
+    """Timezone-aware UTC now (datetime.utcnow is deprecated)"""
+    return datetime.now(timezone.utc)
+
+class MsgStatus(IntEnum):
+    """Message delivery status, stored as a small integer"""
+    PENDING = 0
+    SENT = 1
+    DELIVERED = 2
+    FAILED = 3
+    UNKNOWN = 4
+
 class User(Base):
     """User model for healthcare workers"""
     __tablename__ = "users"
@@ -61,7 +190,7 @@ class User(Base):
     name = Column(String, nullable=False)
     email = Column(String, unique=True, index=True, nullable=False)
     password_hash = Column(String, nullable=False)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime, default=utc_now)
     
     # Relationships
     message_logs = relationship("MessageLog", back_populates="user")
@@ -73,8 +202,8 @@ class Patient(Base):
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, nullable=False)
     phone = Column(String, nullable=False)
-    user_id = Column(Integer, ForeignKey("users.id"))
-    created_at = Column(DateTime, default=datetime.utcnow)
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
+    created_at = Column(DateTime, default=utc_now)
     
     # Relationships
     message_logs = relationship("MessageLog", back_populates="patient")
@@ -82,21 +211,100 @@ class Patient(Base):
 class MessageLog(Base):
     """Message log model for tracking SMS delivery"""
     __tablename__ = "message_logs"
+    __table_args__ = (
+        Index("ix_msglogs_user_status", "user_id", "status"),  # analytics
+        Index("ix_msglogs_user_ts", "user_id", "timestamp"),  # get_logs ordering
+        Index("ix_msglogs_message_id", "message_id", unique=True),  # delivery_report lookup
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"))
     patient_id = Column(Integer, ForeignKey("patients.id"))
     message_text = Column(String, nullable=False)
-    status = Column(String, default="pending")  # pending, sent, delivered, failed
-    message_id = Column(String, nullable=True)  # Africa's Talking message ID
-    timestamp = Column(DateTime, default=datetime.utcnow)
+    status = Column(SmallInteger, default=MsgStatus.PENDING, nullable=False)  # MsgStatus
+    message_id = Column(String, nullable=True)  # Africa's Talking message ID (unique when set)
+    timestamp = Column(DateTime, default=utc_now)
     
     # Relationships
     user = relationship("User", back_populates="message_logs")
     patient = relationship("Patient", back_populates="message_logs")
 
-# Create tables
-Base.metadata.create_all(bind=engine)
+def migrate_message_log_status(conn):
+    """
+    One-off migration for databases created when message_logs.status was a string
+    SQLite cannot change a column's type in place, so the table is rebuilt
+    """
+    columns = {c["name"]: c["type"] for c in inspect(conn).get_columns("message_logs")}
+    if isinstance(columns["status"], SmallInteger):
+        return
+    
+    conn.exec_driver_sql("ALTER TABLE message_logs RENAME TO message_logs_legacy")
+    # Index names move with the renamed table; drop them so the new table can reuse them
+    legacy_indexes = conn.exec_driver_sql(
+        "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'message_logs_legacy' AND sql IS NOT NULL"
+    ).scalars().all()
+    for index_name in legacy_indexes:
+        conn.exec_driver_sql(f'DROP INDEX "{index_name}"')
+    MessageLog.__table__.create(conn)
+    
+    # Rejected sends stored the literal "None", and old mock IDs could collide;
+    # keep only the first occurrence of each ID so the unique index holds
+    conn.exec_driver_sql(f"""
+        INSERT INTO message_logs (id, user_id, patient_id, message_text, status, message_id, timestamp)
+        SELECT id, user_id, patient_id, message_text,
+               CASE status
+                   WHEN 'pending' THEN {MsgStatus.PENDING:d}
+                   WHEN 'sent' THEN {MsgStatus.SENT:d}
+                   WHEN 'delivered' THEN {MsgStatus.DELIVERED:d}
+                   WHEN 'failed' THEN {MsgStatus.FAILED:d}
+                   ELSE {MsgStatus.UNKNOWN:d}
+               END,
+               CASE WHEN ROW_NUMBER() OVER (PARTITION BY message_id ORDER BY id) = 1
+                    THEN NULLIF(message_id, 'None')
+               END,
+               timestamp
+        FROM message_logs_legacy
+    """)
+    conn.exec_driver_sql("DROP TABLE message_logs_legacy")
+
+def create_missing_indexes(conn):
+    """
+    CREATE INDEX IF NOT EXISTS for every model index
+    create_all only builds indexes together with new tables, so databases created
+    before an index was added to a model would otherwise never get it
+    """
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+def init_db():
+    """
+    Create tables and run one-off migrations
+    Runs once before serving (gunicorn on_starting hook), not in every worker,
+    and holds an exclusive lock so overlapping runs are still safe
+    """
+    # Plain pysqlite engine: schema setup is synchronous and must not share the async pool
+    setup_engine = create_engine(make_url(DATABASE_URL).set(drivername="sqlite"), poolclass=NullPool)
+    
+    @event.listens_for(setup_engine, "connect")
+    def disable_pysqlite_transactions(dbapi_connection, connection_record):
+        # pysqlite would otherwise defer BEGIN and run DDL outside the transaction
+        dbapi_connection.isolation_level = None
+        dbapi_connection.execute("PRAGMA busy_timeout=60000")
+    
+    @event.listens_for(setup_engine, "begin")
+    def begin_immediate(conn):
+        # Take the write lock up front so concurrent runs queue behind one another;
+        # each then sees the finished schema and the rebuild is all-or-nothing
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+    
+    try:
+        with setup_engine.begin() as conn:
+            Base.metadata.create_all(conn)
+            migrate_message_log_status(conn)
+            create_missing_indexes(conn)
+    finally:
+        setup_engine.dispose()
 
 # ============== PYDANTIC SCHEMAS ==============
 
@@ -115,12 +323,25 @@ class Token(BaseModel):
 
 class PatientCreate(BaseModel):
     name: str
-    phone: str = Field(..., pattern=r'^\+?\d{10,15}$')
+    phone: str
+    
+    @field_validator("phone")
+    @classmethod
+    def validate_phone(cls, v: str) -> str:
+        """Optional leading +, then 10-15 ASCII digits (plain str checks instead of a regex)"""
+        digits = v[1:] if v.startswith("+") else v
+        if not (10 <= len(digits) <= 15 and digits.isascii() and digits.isdigit()):
+            raise ValueError("Phone number must be 10-15 digits, optionally starting with +")
+        return v
 
 class SMSRequest(BaseModel):
     patient_id: int
     message_text: str = Field(..., min_length=1, max_length=500)
 
+class BulkSMSRequest(BaseModel):
+    patient_ids: List[int] = Field(..., min_length=1)
+    message_text: str = Field(..., min_length=1, max_length=500)
+
 class DeliveryReport(BaseModel):
     """Webhook payload from Africa's Talking"""
     id: str
@@ -139,261 +360,490 @@ class MessageLogResponse(BaseModel):
     class Config:
         from_attributes = True
 
+class CurrentUser(NamedTuple):
+    """Lightweight authenticated user, safe to cache outside a DB session"""
+    id: int
+    email: str
+    name: str
+
 # ============== HELPER FUNCTIONS ==============
 
-def get_db():
+async def get_db():
     """Database dependency"""
-    db = SessionLocal()
-    try:
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
-def hash_password(password: str) -> str:
-    """Hash password using bcrypt"""
+async def hash_password(password: str) -> str:
+    """Hash password using bcrypt (off the event loop)"""
     # Ensure password is within bcrypt's 72 byte limit
     if len(password.encode('utf-8')) > 72:
         password = password[:72]
-    return pwd_context.hash(password)
+    return await run_in_threadpool(pwd_context.hash, password)
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    """Verify password against hash"""
-    return pwd_context.verify(plain_password, hashed_password)
+async def verify_password(plain_password: str, hashed_password: str) -> tuple[bool, Optional[str]]:
+    """
+    Verify password against hash (off the event loop)
+    Returns (valid, new_hash) where new_hash is set when the stored hash should be upgraded
+    """
+    return await run_in_threadpool(pwd_context.verify_and_update, plain_password, hashed_password)
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     """Create JWT access token"""
     to_encode = data.copy()
-    expire = datetime.utcnow() + (expires_delta or timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
+    expire = utc_now() + (expires_delta or timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
     to_encode.update({"exp": expire})
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
-def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security), 
-                     db: Session = Depends(get_db)) -> User:
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security),
+                           db: AsyncSession = Depends(get_db)) -> CurrentUser:
     """Verify JWT token and return current user"""
-    try:
-        token = credentials.credentials
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get("sub")
-        if email is None:
+    token = credentials.credentials
+    token_key = blake2b(token.encode(), digest_size=16).digest()
+    
+    # Reuse the payload of a token already verified by this process until it expires
+    payload = token_cache.get(token_key)
+    if payload is None or payload.get("exp", 0) <= time.time():
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        except JWTError:
             raise HTTPException(status_code=401, detail="Invalid authentication credentials")
-    except JWTError:
+        # Only tokens with a numeric exp can be re-checked on a hit; others are verified every time
+        if isinstance(payload.get("exp"), (int, float)):
+            token_cache[token_key] = payload
+    
+    email: str = payload.get("sub")
+    if email is None:
         raise HTTPException(status_code=401, detail="Invalid authentication credentials")
     
-    user = db.query(User).filter(User.email == email).first()
-    if user is None:
+    cached_user = user_cache.get(email)
+    if cached_user is not None:
+        return cached_user
+    
+    result = await db.execute(select(User.id, User.email, User.name).where(User.email == email))
+    row = result.one_or_none()
+    if row is None:
         raise HTTPException(status_code=401, detail="User not found")
-    return user
+    
+    current_user = CurrentUser(*row)
+    user_cache[email] = current_user
+    return current_user
 
 def mock_africastalking_send_sms(phone: str, message: str) -> dict:
     """
     Mock Africa's Talking SMS API response
     Replace this with actual API call in production
     """
-    import random
-    message_id = f"ATXid_{random.randint(100000, 999999)}"
+    numbers = phone.split(",")
     
     return {
         "SMSMessageData": {
-            "Message": "Sent to 1/1 Total Cost: KES 0.8000",
+            "Message": f"Sent to {len(numbers)}/{len(numbers)} Total Cost: KES {0.8 * len(numbers):.4f}",
             "Recipients": [{
                 "statusCode": 101,  # 101 = Success
-                "number": phone,
+                "number": number,
                 "status": "Success",
                 "cost": "KES 0.8000",
-                "messageId": message_id
-            }]
+                "messageId": f"ATXid_{token_hex(8)}"
+            } for number in numbers]
         }
     }
 
+def analytics_cache_key(user_id: int) -> str:
+    return f"medlink:analytics:{user_id}"
+
+async def get_cached_analytics(user_id: int) -> Optional[dict]:
+    """Cached analytics for a user, or None on a miss (Redis errors count as a miss)"""
+    if redis_client is None:
+        return analytics_cache.get(user_id)
+    try:
+        cached = await redis_client.get(analytics_cache_key(user_id))
+    except redis.RedisError:
+        return None
+    return orjson.loads(cached) if cached else None
+
+async def set_cached_analytics(user_id: int, analytics: dict):
+    """Store analytics for a user for ANALYTICS_CACHE_TTL_SECONDS"""
+    if redis_client is None:
+        analytics_cache[user_id] = analytics
+        return
+    try:
+        await redis_client.set(analytics_cache_key(user_id), orjson.dumps(analytics), ex=ANALYTICS_CACHE_TTL_SECONDS)
+    except redis.RedisError:
+        pass
+
+async def invalidate_analytics(*user_ids: int):
+    """Drop cached analytics after a user's message logs change"""
+    if redis_client is None:
+        for user_id in user_ids:
+            analytics_cache.pop(user_id, None)
+        return
+    try:
+        await redis_client.delete(*(analytics_cache_key(user_id) for user_id in user_ids))
+    except redis.RedisError:
+        pass
+
+def normalize_phone(phone: str) -> str:
+    """International +<digits> form, as Africa's Talking reports recipient numbers"""
+    return "+" + phone.lstrip("+")
+
+def recipient_message_id(recipient: dict) -> Optional[str]:
+    """Africa's Talking message ID for an accepted recipient (rejected ones report "None")"""
+    if recipient.get("statusCode") != 101:
+        return None
+    return recipient.get("messageId")
+
+class RateLimitError(Exception):
+    """Africa's Talking throttled the request; safe to retry after a backoff"""
+
+@retry(
+    retry=retry_if_exception_type(RateLimitError),
+    wait=wait_exponential(min=0.5, max=8),
+    stop=stop_after_attempt(3),
+    reraise=True
+)
+async def post_africastalking_sms(phone: str, message: str) -> dict:
+    """POST to the Africa's Talking messaging API within the concurrency and rate limits"""
+    async with sms_semaphore, sms_rate_limiter:
+        response = await http_client.post(
+            AFRICASTALKING_SMS_URL,
+            headers={"apiKey": AFRICASTALKING_API_KEY, "Accept": "application/json"},
+            data={"username": AFRICASTALKING_USERNAME, "to": phone, "message": message},
+        )
+    
+    if response.status_code == 429 or "Throughput Rate Exceeded" in response.text:
+        raise RateLimitError(response.text)
+    response.raise_for_status()
+    return response.json()
+
+async def africastalking_send_sms(phone: str, message: str) -> dict:
+    """
+    Send SMS through Africa's Talking REST API
+    `phone` may be a comma-separated list to send to several recipients in one call
+    Falls back to the mock response when no API key is configured
+    """
+    if AFRICASTALKING_API_KEY == "mock-api-key":
+        return mock_africastalking_send_sms(phone, message)
+    
+    return await post_africastalking_sms(phone, message)
+
 # ============== API ENDPOINTS ==============
 
 @app.get("/")
-def read_root():
+async def read_root():
     """Health check endpoint"""
     return {"status": "healthy", "service": "MedLink SMS API"}
 
 @app.post("/register", response_model=Token)
-def register(user_data: UserRegister, db: Session = Depends(get_db)):
+async def register(user_data: UserRegister, db: AsyncSession = Depends(get_db)):
     """Register new healthcare worker"""
     # Check if user already exists
-    existing_user = db.query(User).filter(User.email == user_data.email).first()
+    result = await db.execute(select(User.id).where(User.email == user_data.email))
+    existing_user = result.scalar_one_or_none()
     if existing_user:
         raise HTTPException(status_code=400, detail="Email already registered")
     
-    # Create new user
-    new_user = User(
+    # Create new user (Core insert, no ORM instance or refresh needed)
+    await db.execute(insert(User).values(
         name=user_data.name,
         email=user_data.email,
-        password_hash=hash_password(user_data.password)
-    )
-    db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+        password_hash=await hash_password(user_data.password)
+    ))
+    await db.commit()
+    user_cache.pop(user_data.email, None)
     
     # Create access token
-    access_token = create_access_token(data={"sub": new_user.email})
+    access_token = create_access_token(data={"sub": user_data.email})
     
     return {"access_token": access_token, "token_type": "bearer"}
 
 @app.post("/login", response_model=Token)
-def login(credentials: UserLogin, db: Session = Depends(get_db)):
+async def login(credentials: UserLogin, db: AsyncSession = Depends(get_db)):
     """Authenticate healthcare worker"""
-    user = db.query(User).filter(User.email == credentials.email).first()
+    result = await db.execute(select(User).where(User.email == credentials.email))
+    user = result.scalar_one_or_none()
+    
+    if not user:
+        raise HTTPException(status_code=401, detail="Incorrect email or password")
     
-    if not user or not verify_password(credentials.password, user.password_hash):
+    valid, new_hash = await verify_password(credentials.password, user.password_hash)
+    if not valid:
         raise HTTPException(status_code=401, detail="Incorrect email or password")
     
+    # Transparently migrate legacy sha256_crypt hashes to bcrypt
+    if new_hash:
+        user.password_hash = new_hash
+        await db.commit()
+    
     access_token = create_access_token(data={"sub": user.email})
     return {"access_token": access_token, "token_type": "bearer"}
 
 @app.post("/patients")
-def create_patient(patient_data: PatientCreate, 
-                   current_user: User = Depends(get_current_user),
-                   db: Session = Depends(get_db)):
+async def create_patient(patient_data: PatientCreate,
+                         current_user: CurrentUser = Depends(get_current_user),
+                         db: AsyncSession = Depends(get_db)):
     """Add a new patient"""
-    new_patient = Patient(
-        name=patient_data.name,
-        phone=patient_data.phone,
-        user_id=current_user.id
+    result = await db.execute(
+        insert(Patient)
+        .values(name=patient_data.name, phone=patient_data.phone, user_id=current_user.id)
+        .returning(Patient.id)
     )
-    db.add(new_patient)
-    db.commit()
-    db.refresh(new_patient)
+    patient_id = result.scalar_one()
+    await db.commit()
     
-    return {"id": new_patient.id, "name": new_patient.name, "phone": new_patient.phone}
+    return {"id": patient_id, "name": patient_data.name, "phone": patient_data.phone}
 
 @app.get("/patients")
-def get_patients(current_user: User = Depends(get_current_user),
-                 db: Session = Depends(get_db)):
+async def get_patients(current_user: CurrentUser = Depends(get_current_user),
+                       db: AsyncSession = Depends(get_db)):
     """Get all patients for current user"""
-    patients = db.query(Patient).filter(Patient.user_id == current_user.id).all()
-    return patients
+    result = await db.execute(select(Patient).where(Patient.user_id == current_user.id))
+    return result.scalars().all()
 
 @app.post("/send_sms")
-def send_sms(sms_data: SMSRequest,
-             current_user: User = Depends(get_current_user),
-             db: Session = Depends(get_db)):
+async def send_sms(sms_data: SMSRequest,
+                   current_user: CurrentUser = Depends(get_current_user),
+                   db: AsyncSession = Depends(get_db)):
     """
     Send SMS to patient using Africa's Talking API
     Logs the message and returns delivery status
     """
     # Verify patient exists and belongs to user
-    patient = db.query(Patient).filter(
+    result = await db.execute(select(Patient).where(
         Patient.id == sms_data.patient_id,
         Patient.user_id == current_user.id
-    ).first()
+    ))
+    patient = result.scalar_one_or_none()
     
     if not patient:
         raise HTTPException(status_code=404, detail="Patient not found")
     
     # Send SMS via Africa's Talking (mocked for now)
     try:
-        response = mock_africastalking_send_sms(patient.phone, sms_data.message_text)
+        response = await africastalking_send_sms(normalize_phone(patient.phone), sms_data.message_text)
         recipient = response["SMSMessageData"]["Recipients"][0]
         
-        # Create message log
-        message_log = MessageLog(
-            user_id=current_user.id,
-            patient_id=patient.id,
-            message_text=sms_data.message_text,
-            status="sent" if recipient["statusCode"] == 101 else "failed",
-            message_id=recipient.get("messageId")
+        # Create message log (Core insert, no ORM instance to track)
+        log_status = MsgStatus.SENT if recipient["statusCode"] == 101 else MsgStatus.FAILED
+        result = await db.execute(
+            insert(MessageLog)
+            .values(
+                user_id=current_user.id,
+                patient_id=patient.id,
+                message_text=sms_data.message_text,
+                status=log_status,
+                message_id=recipient_message_id(recipient)
+            )
+            .returning(MessageLog.id)
         )
-        db.add(message_log)
-        db.commit()
-        db.refresh(message_log)
-        log_transaction_safe(os.getenv("STELLAR_SECRET_KEY"), f"Sent SMS to {patient.phone}")
+        log_id = result.scalar_one()
+        await db.commit()
+        await invalidate_analytics(current_user.id)
+        # Stellar logging happens on its own thread, off the request path
+        enqueue_transaction_log(os.getenv("STELLAR_SECRET_KEY"), f"Sent SMS to {patient.phone}")
         
         return {
             "success": True,
             "message": "SMS sent successfully",
-            "log_id": message_log.id,
-            "status": message_log.status,
+            "log_id": log_id,
+            "status": log_status.name.lower(),
             "cost": recipient.get("cost")
         }
     
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to send SMS: {str(e)}")
 
+@app.post("/send_sms/bulk")
+async def send_bulk_sms(sms_data: BulkSMSRequest,
+                        current_user: CurrentUser = Depends(get_current_user),
+                        db: AsyncSession = Depends(get_db)):
+    """
+    Send the same SMS to several patients in one Africa's Talking request
+    Logs every recipient with a single multi-row insert
+    Patients sharing a number get one SMS; only the first of them keeps its message ID
+    """
+    result = await db.execute(select(Patient).where(
+        Patient.id.in_(sms_data.patient_ids),
+        Patient.user_id == current_user.id
+    ))
+    patients = result.scalars().all()
+    
+    if not patients:
+        raise HTTPException(status_code=404, detail="Patient not found")
+    
+    try:
+        # Deduplicated, order-preserving recipient list
+        numbers = list(dict.fromkeys(normalize_phone(patient.phone) for patient in patients))
+        response = await africastalking_send_sms(",".join(numbers), sms_data.message_text)
+        recipients = {
+            normalize_phone(r["number"]): r for r in response["SMSMessageData"]["Recipients"]
+        }
+        
+        logs = []
+        numbers_logged = set()
+        for patient in patients:
+            number = normalize_phone(patient.phone)
+            recipient = recipients.get(number, {})
+            # message_id is unique, so a shared number's ID (and its delivery reports) goes to one log
+            message_id = recipient_message_id(recipient) if number not in numbers_logged else None
+            numbers_logged.add(number)
+            logs.append({
+                "user_id": current_user.id,
+                "patient_id": patient.id,
+                "message_text": sms_data.message_text,
+                "status": MsgStatus.SENT if recipient.get("statusCode") == 101 else MsgStatus.FAILED,
+                "message_id": message_id
+            })
+        await db.execute(insert(MessageLog), logs)
+        await db.commit()
+        await invalidate_analytics(current_user.id)
+        enqueue_transaction_log(os.getenv("STELLAR_SECRET_KEY"), f"Sent SMS to {len(patients)} patients")
+        
+        sent = sum(1 for log in logs if log["status"] == MsgStatus.SENT)
+        found_ids = {patient.id for patient in patients}
+        return {
+            "success": True,
+            "message": f"SMS sent to {sent}/{len(logs)} patients",
+            "sent": sent,
+            "failed": len(logs) - sent,
+            "not_found": [pid for pid in sms_data.patient_ids if pid not in found_ids]
+        }
+    
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to send SMS: {str(e)}")
+
 @app.post("/delivery_report")
-def delivery_report(report: DeliveryReport, db: Session = Depends(get_db)):
+async def delivery_report(report: Union[List[DeliveryReport], DeliveryReport],
+                          db: AsyncSession = Depends(get_db)):
     """
     Webhook endpoint to receive delivery status from Africa's Talking
     Updates message status based on delivery confirmation
+    Accepts a single report or a batch, applied with one UPDATE
     """
-    # Find message by Africa's Talking message ID
-    message = db.query(MessageLog).filter(MessageLog.message_id == report.id).first()
-    
-    if not message:
-        return {"status": "not_found", "message": "Message ID not found in logs"}
+    reports = report if isinstance(report, list) else [report]
     
     # Update status based on delivery report
     status_mapping = {
-        "Success": "delivered",
-        "Sent": "sent",
-        "Failed": "failed",
-        "Rejected": "failed"
+        "Success": MsgStatus.DELIVERED,
+        "Sent": MsgStatus.SENT,
+        "Failed": MsgStatus.FAILED,
+        "Rejected": MsgStatus.FAILED
     }
+    new_statuses = {r.id: status_mapping.get(r.status, MsgStatus.UNKNOWN) for r in reports}
+    if not new_statuses:
+        return {"status": "not_found", "message": "Message ID not found in logs"}
+    
+    # Find messages by Africa's Talking message ID
+    result = await db.execute(
+        update(MessageLog)
+        .where(MessageLog.message_id.in_(new_statuses))
+        .values(status=case(new_statuses, value=MessageLog.message_id))
+        .returning(MessageLog.user_id)
+        .execution_options(synchronize_session=False)
+    )
+    updated_user_ids = result.scalars().all()
+    await db.commit()
+    
+    if not updated_user_ids:
+        return {"status": "not_found", "message": "Message ID not found in logs"}
+    
+    await invalidate_analytics(*set(updated_user_ids))
     
-    message.status = status_mapping.get(report.status, "unknown")
-    db.commit()
+    if isinstance(report, list):
+        return {"status": "updated", "updated": len(updated_user_ids)}
     
     return {
         "status": "updated",
         "message_id": report.id,
-        "new_status": message.status
+        "new_status": new_statuses[report.id].name.lower()
     }
 
 @app.get("/get_logs", response_model=List[MessageLogResponse])
-def get_logs(current_user: User = Depends(get_current_user),
-             db: Session = Depends(get_db)):
+async def get_logs(limit: int = Query(100, ge=1, le=1000),
+                   cursor: Optional[str] = None,
+                   current_user: CurrentUser = Depends(get_current_user),
+                   db: AsyncSession = Depends(get_db)):
     """
-    Fetch all message logs for current user
+    Fetch message logs for current user, newest first
     Includes patient details and delivery status
+    Paginated by keyset: pass the X-Next-Cursor response header back as `cursor`
     """
-    logs = db.query(MessageLog).filter(
-        MessageLog.user_id == current_user.id
-    ).order_by(MessageLog.timestamp.desc()).all()
-    
-    result = []
-    for log in logs:
-        result.append(MessageLogResponse(
-            id=log.id,
-            patient_name=log.patient.name,
-            phone=log.patient.phone,
-            message_text=log.message_text,
-            status=log.status,
-            timestamp=log.timestamp
-        ))
-    
-    return result
+    # Single JOIN projecting only the needed columns (avoids per-row patient lookups)
+    query = (
+        select(
+            MessageLog.id,
+            Patient.name,
+            Patient.phone,
+            MessageLog.message_text,
+            MessageLog.status,
+            MessageLog.timestamp
+        )
+        .join(Patient, MessageLog.patient_id == Patient.id)
+        .where(MessageLog.user_id == current_user.id)
+        .order_by(MessageLog.timestamp.desc(), MessageLog.id.desc())
+        .limit(limit + 1)  # one extra row tells us whether another page exists
+    )
+    
+    if cursor:
+        # Cursor is "<timestamp>|<id>" of the last row on the previous page
+        try:
+            cursor_ts, cursor_id = cursor.rsplit("|", 1)
+            cursor_key = (datetime.fromisoformat(cursor_ts), int(cursor_id))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        query = query.where(tuple_(MessageLog.timestamp, MessageLog.id) < cursor_key)
+    
+    result = await db.execute(query)
+    
+    # Plain dicts straight to orjson, skipping per-row Pydantic models
+    logs = [
+        {
+            "id": log_id,
+            "patient_name": patient_name,
+            "phone": phone,
+            "message_text": message_text,
+            "status": MsgStatus(log_status).name.lower(),
+            "timestamp": timestamp
+        }
+        for log_id, patient_name, phone, message_text, log_status, timestamp in result
+    ]
+    
+    headers = {}
+    if len(logs) > limit:
+        logs = logs[:limit]
+        headers["X-Next-Cursor"] = f"{logs[-1]['timestamp'].isoformat()}|{logs[-1]['id']}"
+    
+    return ORJSONResponse(logs, headers=headers)
 
 @app.get("/analytics")
-def get_analytics(current_user: User = Depends(get_current_user),
-                  db: Session = Depends(get_db)):
-    """Get message delivery analytics"""
-    total_messages = db.query(MessageLog).filter(MessageLog.user_id == current_user.id).count()
-    delivered = db.query(MessageLog).filter(
-        MessageLog.user_id == current_user.id,
-        MessageLog.status == "delivered"
-    ).count()
-    failed = db.query(MessageLog).filter(
-        MessageLog.user_id == current_user.id,
-        MessageLog.status == "failed"
-    ).count()
-    pending = db.query(MessageLog).filter(
-        MessageLog.user_id == current_user.id,
-        MessageLog.status.in_(["pending", "sent"])
-    ).count()
+async def get_analytics(current_user: CurrentUser = Depends(get_current_user),
+                        db: AsyncSession = Depends(get_db)):
+    """Get message delivery analytics (cached briefly per user)"""
+    cached = await get_cached_analytics(current_user.id)
+    if cached is not None:
+        return cached
     
-    return {
+    # One pass over the user's logs with conditional sums per status bucket
+    result = await db.execute(
+        select(
+            func.count().label("total"),
+            func.sum(case((MessageLog.status == MsgStatus.DELIVERED, 1), else_=0)).label("delivered"),
+            func.sum(case((MessageLog.status == MsgStatus.FAILED, 1), else_=0)).label("failed"),
+            func.sum(case((MessageLog.status.in_([MsgStatus.PENDING, MsgStatus.SENT]), 1), else_=0)).label("pending")
+        ).where(MessageLog.user_id == current_user.id)
+    )
+    row = result.one()
+    # SUM() over zero rows is NULL
+    total_messages = row.total
+    delivered = row.delivered or 0
+    failed = row.failed or 0
+    pending = row.pending or 0
+    
+    analytics = {
         "total_messages": total_messages,
         "delivered": delivered,
         "failed": failed,
         "pending": pending,
         "delivery_rate": round((delivered / total_messages * 100) if total_messages > 0 else 0, 2)
     }
-
-if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    await set_cached_analytics(current_user.id, analytics)
+    return analytics
@@ -1,6 +1,31 @@
 from stellar_sdk import Server, Keypair, TransactionBuilder, Network, Asset
+from stellar_sdk.exceptions import BadRequestError
+import queue
+import threading
 import traceback
 
+# Use Testnet (one shared client, reuses its HTTP session)
+server = Server("https://horizon-testnet.stellar.org")
+
+# Loaded accounts by public key; the sequence number is tracked locally after the first load.
+# Only the consumer thread below touches it, so no lock is needed.
+_accounts = {}
+
+# Another worker process may have used the same account's sequence number;
+# reload the account and resubmit this many times before giving up
+MAX_SEQUENCE_RETRIES = 3
+
+# Pending logs, drained by one dedicated thread so Horizon round-trips never
+# occupy the request threadpool (shared with password hashing)
+_log_queue = queue.Queue(maxsize=10_000)
+_consumer = None
+_consumer_lock = threading.Lock()
+
+def _is_bad_sequence(error):
+    """True when Horizon rejected the transaction for a stale sequence number"""
+    result_codes = (error.extras or {}).get("result_codes", {})
+    return result_codes.get("transaction") == "tx_bad_seq"
+
 def log_transaction_safe(secret_key, message_content="SMS Log"):
     """
     Attempts to log to Stellar. 
@@ -10,34 +35,74 @@ def log_transaction_safe(secret_key, message_content="SMS Log"):
     if not secret_key:
         return None
 
+    source_keypair = None
     try:
-        # Use Testnet
-        server = Server("https://horizon-testnet.stellar.org")
         source_keypair = Keypair.from_secret(secret_key)
-        
-        # Load account (Network call)
-        source_account = server.load_account(account_id=source_keypair.public_key)
-
-        # Build transaction (Send 1 XLM to self with a memo)
-        transaction = (
-            TransactionBuilder(
-                source_account=source_account,
-                network_passphrase=Network.TESTNET_NETWORK_PASSPHRASE,
-                base_fee=100
+
+        for attempt in range(MAX_SEQUENCE_RETRIES):
+            source_account = _accounts.get(source_keypair.public_key)
+            if source_account is None:
+                # Load account (Network call, only on first use or after a failure)
+                source_account = server.load_account(account_id=source_keypair.public_key)
+                _accounts[source_keypair.public_key] = source_account
+
+            # Build transaction (Send 1 XLM to self with a memo)
+            # build() increments the cached account's sequence number
+            transaction = (
+                TransactionBuilder(
+                    source_account=source_account,
+                    network_passphrase=Network.TESTNET_NETWORK_PASSPHRASE,
+                    base_fee=100
+                )
+                .append_payment_op(destination=source_keypair.public_key, asset=Asset.native(), amount="1")
+                .add_text_memo("MedLink Log") # Simple text memo
+                .set_timeout(30)
+                .build()
             )
-            .append_payment_op(destination=source_keypair.public_key, asset=Asset.native(), amount="1")
-            .add_text_memo("MedLink Log") # Simple text memo
-            .set_timeout(30)
-            .build()
-        )
-
-        # Submit
-        transaction.sign(source_keypair)
-        response = server.submit_transaction(transaction)
-        print(f"Stellar Log Success: {response['hash']}")
-        return response['hash']
+
+            # Submit
+            transaction.sign(source_keypair)
+            try:
+                response = server.submit_transaction(transaction)
+            except BadRequestError as e:
+                if not _is_bad_sequence(e) or attempt == MAX_SEQUENCE_RETRIES - 1:
+                    raise
+                # Sequence moved on elsewhere; reload and try again
+                _accounts.pop(source_keypair.public_key, None)
+                continue
+            print(f"Stellar Log Success: {response['hash']}")
+            return response['hash']
 
     except Exception:
+        # Sequence may be out of sync now; reload the account next time
+        if source_keypair is not None:
+            _accounts.pop(source_keypair.public_key, None)
         # SAFETY NET: Just print error and continue. Do NOT raise exception.
         print("Stellar Log Skipped (Error ignored)")
-        return None
\ No newline at end of file
+        return None
+
+def _consume_logs():
+    """Consumer thread: submits queued logs one at a time, in order"""
+    while True:
+        secret_key, message_content = _log_queue.get()
+        log_transaction_safe(secret_key, message_content)
+        _log_queue.task_done()
+
+def enqueue_transaction_log(secret_key, message_content="SMS Log"):
+    """
+    Queue a Stellar log for the background consumer thread and return immediately.
+    The thread starts on first use, i.e. inside the worker process after any fork.
+    """
+    if not secret_key:
+        return
+
+    global _consumer
+    with _consumer_lock:
+        if _consumer is None or not _consumer.is_alive():
+            _consumer = threading.Thread(target=_consume_logs, name="stellar-log", daemon=True)
+            _consumer.start()
+
+    try:
+        _log_queue.put_nowait((secret_key, message_content))
+    except queue.Full:
+        print("Stellar Log Skipped (queue full)")